@@ -0,0 +1,118 @@
+import re, threading, uuid
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+
+# Admission control for expensive queries. The static checks in do_api_search
+# (indexed fields, offset/limit caps) still let through filter and sort
+# combinations that are slow to run. Here we estimate the cost of a query
+# before running it and, for models that declare a threshold, allow only a
+# few expensive queries per model to run at once so that they don't pile up
+# and starve the workers.
+
+_semaphores = { }
+_semaphores_lock = threading.Lock()
+
+def estimate_query_cost(model, qs, qs_type, qs_filters, qs_sort):
+    """Estimates the cost of a query, either from the database's EXPLAIN row
+    estimates or from the weights declared in the model's api_query_costs."""
+
+    if getattr(model, "api_query_cost_explain", False) and qs_type == "QuerySet":
+        cost = get_explain_row_estimate(qs)
+        if cost is not None:
+            return cost
+
+    # api_query_costs maps field names, or fieldname__operator for a particular
+    # filter operator, to weights. Sorting on a field costs its field weight.
+    weights = getattr(model, "api_query_costs", {})
+    cost = 0
+    for fieldname, (matchoperator, modelfield) in qs_filters.items():
+        cost += weights.get(fieldname + "__" + matchoperator, weights.get(fieldname, 0))
+    for fieldname, ascdesc in qs_sort:
+        cost += weights.get(fieldname, 0)
+    return cost
+
+def get_explain_row_estimate(qs):
+    """Returns the largest row estimate in the query plan, or None if the
+    database backend's plan can't be read."""
+
+    vendor = connections[qs.db].vendor
+    try:
+        if vendor == "postgresql":
+            plan = qs.explain()
+            rows = re.findall(r"rows=(\d+)", plan)
+        elif vendor == "mysql":
+            plan = qs.explain(format="json")
+            rows = re.findall(r'"rows_examined_per_scan": (\d+)', plan)
+        else:
+            return None
+    except Exception:
+        # Let the real query report any errors.
+        return None
+
+    if len(rows) == 0:
+        return None
+    return max(int(r) for r in rows)
+
+class SharedSemaphore(object):
+    """A semaphore shared by all processes using one cache key per slot, with the
+    acquire/release interface of threading.BoundedSemaphore. Create one per
+    query: it remembers which slot it took."""
+
+    def __init__(self, cache, key, value):
+        self.cache = cache
+        self.key = key
+        self.value = value
+        self.slot = None
+
+    def acquire(self, blocking=True):
+        # Slots expire so that slots held by processes that died while running
+        # a query are eventually freed.
+        token = uuid.uuid4().hex
+        for i in range(self.value):
+            slot = "%s:slot:%d" % (self.key, i)
+            if self.cache.add(slot, token, getattr(settings, "API_ADMISSION_TTL", 300)):
+                self.slot = (slot, token)
+                return True
+        return False
+
+    def release(self):
+        slot, token = self.slot
+        self.slot = None
+        # If the query outlasted the slot, another query may hold it now.
+        # Leave its slot alone.
+        if self.cache.get(slot) == token:
+            self.cache.delete(slot)
+
+def get_model_semaphore(model):
+    limit = getattr(model, "api_max_expensive_queries", 2)
+
+    # With a cache configured, count expensive queries across all processes,
+    # which is what matters when each worker process serves one request at a time.
+    cache_alias = getattr(settings, "API_ADMISSION_CACHE", None)
+    if cache_alias:
+        from django.core.cache import caches
+        return SharedSemaphore(caches[cache_alias],
+            "simplegetapi:admission:%s.%s" % (model._meta.app_label, model._meta.object_name), limit)
+
+    with _semaphores_lock:
+        if model not in _semaphores:
+            _semaphores[model] = threading.BoundedSemaphore(limit)
+        return _semaphores[model]
+
+def get_admission_semaphore(model, qs, qs_type, qs_filters, qs_sort):
+    """Returns the semaphore that must be held while running the query if it is
+    an expensive query, or None if the query may run without limits."""
+
+    threshold = getattr(model, "api_expensive_query_cost", None)
+    if threshold is None:
+        return None
+    if estimate_query_cost(model, qs, qs_type, qs_filters, qs_sort) < threshold:
+        return None
+    return get_model_semaphore(model)
+
+def too_busy_response():
+    resp = HttpResponse("Too many expensive queries are running right now. Try again later or narrow your query.", status=503, content_type="text/plain; charset=UTF-8")
+    resp["Retry-After"] = str(getattr(settings, "API_RETRY_AFTER", 5))
+    return resp
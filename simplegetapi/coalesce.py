@@ -0,0 +1,139 @@
+import threading, time, uuid, hashlib
+
+try:
+    # Python 2.x
+    from urllib import urlencode
+except ImportError:
+    # Python 3.x
+    from urllib.parse import urlencode
+
+from django.conf import settings
+from django.http import HttpResponse
+
+# Single-flight coalescing of identical concurrent API requests. When many clients
+# request the same URL at the same moment, only one of them (the "leader") runs the
+# count, fetch and serialization. The others wait for it to finish and then get a copy
+# of the encoded response. Nothing is kept once the in-flight computation is done,
+# so this is not a cache: a request that arrives after the leader finished starts
+# a new flight.
+
+_inflight = { }
+_inflight_lock = threading.Lock()
+
+class _Flight(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None # set by the leader to a packed response on success
+
+def is_enabled():
+    return getattr(settings, "API_COALESCE_REQUESTS", False)
+
+def get_request_key(request, model):
+    """Returns a key identifying an API request by its model, path and canonical query string."""
+
+    try:
+        # Python 2.x
+        querystringargs = request.GET.iterlists()
+    except AttributeError:
+        # Python 3.x
+        querystringargs = request.GET.lists()
+
+    # Sort the parameters by name but keep the order of repeated values, which
+    # is significant for e.g. ?sort=.
+    query = urlencode(sorted(((arg, v) for arg, vals in querystringargs for v in vals), key=lambda kv : kv[0]))
+
+    key = "%s.%s|%s|%s" % (model._meta.app_label, model._meta.object_name, request.path, query)
+    return hashlib.sha1(key.encode("utf8")).hexdigest()
+
+def pack_response(resp):
+    return (resp.status_code, resp.content, list(resp.items()))
+
+def unpack_response(packed):
+    status_code, content, headers = packed
+    resp = HttpResponse(content, status=status_code)
+    for header, value in headers:
+        resp[header] = value
+    return resp
+
+def coalesce(key, compute):
+    """Runs compute(), which returns an HttpResponse, unless an identical request is
+    already in flight, in which case the in-flight response is shared."""
+
+    timeout = getattr(settings, "API_COALESCE_TIMEOUT", 30)
+
+    # Join an in-flight computation in this process or become its leader.
+    with _inflight_lock:
+        flight = _inflight.get(key)
+        is_leader = flight is None
+        if is_leader:
+            flight = _inflight[key] = _Flight()
+
+    if not is_leader:
+        # Wait for the leader. If it failed or is taking too long, compute
+        # independently.
+        flight.done.wait(timeout)
+        if flight.result is None:
+            return compute()
+        return unpack_response(flight.result)
+
+    try:
+        flight.result = pack_response(_coalesce_across_processes(key, compute, timeout))
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+        flight.done.set()
+
+    return unpack_response(flight.result)
+
+def _coalesce_across_processes(key, compute, timeout):
+    # If a cache is configured, coordinate with other processes using a lock
+    # entry in the cache. The lock holds a token naming where its result will
+    # be stored so that a waiter never picks up the result of an earlier flight.
+    cache_alias = getattr(settings, "API_COALESCE_CACHE", None)
+    if not cache_alias:
+        return compute()
+
+    from django.core.cache import caches
+    cache = caches[cache_alias]
+    lock_key = "simplegetapi:coalesce:lock:" + key
+
+    deadline = time.time() + timeout
+    while True:
+        token = uuid.uuid4().hex
+        if cache.add(lock_key, token, timeout):
+            # We are the leader across processes.
+            try:
+                resp = compute()
+                # Don't share responses too large for the cache (memcached
+                # silently drops items over 1 MB by default). Waiters then
+                # compute the response themselves.
+                if len(resp.content) <= getattr(settings, "API_COALESCE_MAX_SIZE", 1000000):
+                    cache.set("simplegetapi:coalesce:result:" + token, pack_response(resp), timeout)
+                return resp
+            finally:
+                # If compute() outlasted the lock, another process may hold it
+                # now. Leave its lock alone.
+                if cache.get(lock_key) == token:
+                    cache.delete(lock_key)
+
+        # Another process holds the lock. Poll for its result.
+        token = cache.get(lock_key)
+        if token is None and time.time() < deadline:
+            # The lock was released before we could read it. Try again.
+            continue
+        while token is not None and time.time() < deadline:
+            packed = cache.get("simplegetapi:coalesce:result:" + token)
+            if packed is not None:
+                return unpack_response(packed)
+            time.sleep(0.05)
+            if cache.get(lock_key) != token:
+                # The flight ended. Check one last time for its result.
+                packed = cache.get("simplegetapi:coalesce:result:" + token)
+                if packed is not None:
+                    return unpack_response(packed)
+                break
+
+        # The flight ended without a shareable result (e.g. it was too large
+        # for the cache or the other process failed) or we waited too long.
+        # Compute independently rather than queueing up behind another leader.
+        return compute()
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+
+from simplegetapi import usage
+
+class Command(BaseCommand):
+    help = "Reports the slowest filter/sort combinations sent to the API and suggests indexes or api_filter_if rules. Requires API_USAGE_STATS = True."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=20, help="How many of the slowest query shapes to show.")
+        parser.add_argument("--min-requests", type=int, default=1, help="Ignore query shapes seen fewer than this many times.")
+        parser.add_argument("--reset", action="store_true", help="Clear the recorded statistics after reporting.")
+
+    def handle(self, *args, **options):
+        stats = usage.get_stats()
+
+        # Flatten to (model, shape, stats) and sort by mean latency, slowest first.
+        rows = [
+            (model_label, shape, shape_stats)
+            for model_label, shapes in stats.items()
+            for shape, shape_stats in shapes.items()
+            if shape_stats["count"] >= options["min_requests"]
+        ]
+        rows.sort(key=lambda row : row[2]["total_time"] / row[2]["count"], reverse=True)
+
+        if len(rows) == 0:
+            self.stdout.write("No API usage has been recorded.")
+
+        for model_label, shape, shape_stats in rows[:options["limit"]]:
+            filters, sort = shape
+            p95 = usage.get_latency_percentile(shape_stats, 95)
+
+            self.stdout.write(model_label)
+            self.stdout.write("  filters: %s" % (", ".join(f + "__" + op for f, op in filters) or "(none)"))
+            self.stdout.write("  sort: %s" % (", ".join((f if ascdesc == "+" else "-" + f) for f, ascdesc in sort) or "(none)"))
+            self.stdout.write("  requests: %d, mean %.0f ms, p95 %s, max %.0f ms, mean rows %.0f, max rows %d" % (
+                shape_stats["count"],
+                shape_stats["total_time"] / shape_stats["count"] * 1000.0,
+                ("<= %d ms" % p95) if p95 is not None else ("> %d ms" % usage.LATENCY_BUCKETS[-1]),
+                shape_stats["max_time"] * 1000.0,
+                shape_stats["total_rows"] / float(shape_stats["count"]),
+                shape_stats["max_rows"],
+            ))
+
+            index_fields = usage.suggest_index(shape)
+            if index_fields:
+                self.stdout.write("  suggestion: add a composite index, e.g. models.Index(fields=[%s])" % ", ".join("'%s'" % f for f in index_fields))
+
+            filter_if = usage.suggest_filter_if(shape, stats[model_label])
+            if filter_if:
+                self.stdout.write("  suggestion: require a second filter, e.g. api_filter_if = { '%s': ('%s',) }" % filter_if)
+
+            self.stdout.write("")
+
+        if options["reset"]:
+            usage.reset_stats()
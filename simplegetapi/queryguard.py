@@ -0,0 +1,71 @@
+import logging, threading
+
+from django.conf import settings
+from django.db import connections
+
+try:
+    from contextlib import ExitStack
+except ImportError:
+    ExitStack = None # Python 2.x, where Django lacks execute_wrapper anyway
+
+# Detection of N+1 queries during serialization. serialize_object only avoids
+# database queries when model authors list the relations it walks in
+# api_recurse_on so that they are prefetched. A missing entry, a reverse
+# OneToOne accessor or an api_additional_fields function can instead issue a
+# query for every object on a page. While a QueryCounter is active, each query
+# is attributed to the field path serialize_object is processing.
+
+logger = logging.getLogger(__name__)
+
+_active = threading.local()
+
+class NPlusOneQueryError(Exception):
+    pass
+
+class QueryCounter(object):
+    """Context manager that counts the queries run on all database connections
+    in this thread, by the field path being serialized when they ran."""
+
+    def __init__(self):
+        self.count = 0
+        self.by_path = { }
+        self.path = [] # the field path serialize_object is in, maintained by serialize_object
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        path = "__".join(self.path)
+        self.by_path[path] = self.by_path.get(path, 0) + 1
+        return execute(sql, params, many, context)
+
+    def __enter__(self):
+        self.stack = ExitStack()
+        for alias in connections:
+            self.stack.enter_context(connections[alias].execute_wrapper(self))
+        self.outer = getattr(_active, "counter", None)
+        _active.counter = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _active.counter = self.outer
+        self.stack.close()
+
+def get_active_counter():
+    return getattr(_active, "counter", None)
+
+def is_enabled():
+    return getattr(settings, "API_SERIALIZATION_QUERY_GUARD", None) in ("log", "raise")
+
+def check_serialization_queries(model, counter, num_objects):
+    """Logs or raises (according to the API_SERIALIZATION_QUERY_GUARD setting) for
+    each field path that ran at least one query per serialized object."""
+
+    if num_objects == 0:
+        return
+    for path, count in sorted(counter.by_path.items()):
+        if count < num_objects:
+            continue
+        message = "%d queries while serializing %d %s objects at field %s. Add it to api_recurse_on or avoid queries in api_additional_fields." % (
+            count, num_objects, model._meta.object_name, path or "(none)")
+        if settings.API_SERIALIZATION_QUERY_GUARD == "raise":
+            raise NPlusOneQueryError(message)
+        logger.warning(message)
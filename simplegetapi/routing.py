@@ -0,0 +1,103 @@
+import random, threading, time
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+
+# Routing of API queries to read replicas. A model's api_database attribute names
+# the database alias to read from. The alias is chosen once per API request and
+# all of the request's queries (the count, the page fetch, prefetches and the bulk
+# load for Haystack searches) are run against it, so that they share one
+# connection.
+
+# Recently checked replica lags, by alias, as (time checked, lag).
+_lags = { }
+_lags_lock = threading.Lock()
+
+def get_model_database(model):
+    """Returns the database alias to use for an API request on the model, or None
+    to leave the choice to the database routers."""
+
+    # api_database is an alias, a list of aliases to pick from at random, or a
+    # function that takes the model and returns an alias.
+    database = getattr(model, "api_database", None)
+    if callable(database):
+        database = database(model)
+    if database is None:
+        return None
+    if isinstance(database, (list, tuple)):
+        candidates = list(database)
+        random.shuffle(candidates)
+    else:
+        candidates = [database]
+
+    # If the model tolerates only so much replica lag, skip replicas that are
+    # further behind than that or whose lag can't be checked, and fall back to
+    # the primary if none are caught up.
+    max_lag = getattr(model, "api_database_max_lag", None)
+    if max_lag is None:
+        return candidates[0]
+    for database in candidates:
+        if database == DEFAULT_DB_ALIAS:
+            return database
+        lag = get_cached_replica_lag(database)
+        if lag is not None and lag <= max_lag:
+            return database
+    return DEFAULT_DB_ALIAS
+
+def get_cached_replica_lag(database):
+    """Returns the replica's lag as of the last few seconds (the
+    API_REPLICA_LAG_CACHE_SECONDS setting, default 5), or None if it is not known."""
+
+    with _lags_lock:
+        checked = _lags.get(database)
+    if checked is not None and time.time() - checked[0] < getattr(settings, "API_REPLICA_LAG_CACHE_SECONDS", 5):
+        return checked[1]
+
+    try:
+        lag = get_replica_lag(database)
+    except Exception:
+        lag = None
+
+    with _lags_lock:
+        _lags[database] = (time.time(), lag)
+    return lag
+
+def get_replica_lag(database):
+    """Returns how many seconds the replica is behind its primary, or None if
+    it is not known."""
+
+    # A site can provide its own lag check as a function taking the alias.
+    lag_function = getattr(settings, "API_REPLICA_LAG_FUNCTION", None)
+    if lag_function:
+        if not callable(lag_function):
+            from django.utils.module_loading import import_string
+            lag_function = import_string(lag_function)
+        return lag_function(database)
+
+    connection = connections[database]
+    if connection.vendor == "postgresql":
+        # The time since the last replayed transaction keeps growing while the
+        # primary has no writes, so it only measures lag while the replica
+        # hasn't yet replayed everything it has received (PostgreSQL 10+).
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0 "
+                           "WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                           "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END")
+            lag = cursor.fetchone()[0]
+        return float(lag) if lag is not None else None
+    if connection.vendor == "mysql":
+        # MySQL 8.0.22+ has SHOW REPLICA STATUS. MySQL 8.4 removed SHOW SLAVE STATUS.
+        for statement, column in (("SHOW REPLICA STATUS", "Seconds_Behind_Source"), ("SHOW SLAVE STATUS", "Seconds_Behind_Master")):
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(statement)
+                    row = cursor.fetchone()
+                    if row is None:
+                        return 0 # not a replica
+                    columns = [c[0] for c in cursor.description]
+                    lag = row[columns.index(column)]
+                return float(lag) if lag is not None else None
+            except Exception:
+                continue
+        return None
+    return None
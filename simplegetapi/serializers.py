@@ -1,4 +1,4 @@
-import datetime, json, csv, lxml.etree, decimal
+import datetime, json, csv, lxml.etree, decimal, pickle, threading
 
 try:
     # Python 2.x
@@ -9,11 +9,20 @@ except ImportError:
     unicode = str
     long = int
 
+try:
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+except ImportError:
+    # Python 2.x
+    ProcessPoolExecutor = None
+
+from django.conf import settings
 from django.http import HttpResponse
 from django.db.models import Model
 from django.db.models.fields.related import ForeignKey, ManyToManyField
 
 from simplegetapi.utils import is_enum, enum_value_to_key_and_label, get_orm_fields
+from simplegetapi.queryguard import get_active_counter
 
 def serialize_object(obj, recurse_on=[], requested_fields=None):
     """Serializes a Python object to JSON-able data types (listed in the 1st if block below)."""
@@ -39,6 +48,9 @@ def serialize_object(obj, recurse_on=[], requested_fields=None):
         # requested_fields supports field__field chaining, so just take the first part
         # of each specified field.
         local_fields = [f.split("__", 1)[0] for f in requested_fields] if requested_fields else None
+
+        # If we're counting queries, attribute them to the field being serialized.
+        query_counter = get_active_counter()
         
         # Loop through the fields on this model. Be sure to process only
         # fields that will not cause additional database queries. ForeignKey,
@@ -61,6 +73,9 @@ def serialize_object(obj, recurse_on=[], requested_fields=None):
                 ret[field_name] = getattr(obj, field_name + "_id")
                 continue
                 
+            if query_counter is not None:
+                query_counter.path.append(field_name)
+
             # Get the field value.
             if not isinstance(field, (str, unicode)):
                 # for standard fields
@@ -112,6 +127,9 @@ def serialize_object(obj, recurse_on=[], requested_fields=None):
             # For all other values, serialize by recursion.
             else:
                 ret[field_name] = serialize_object(v, recurse_on=sub_recurse_on, requested_fields=sub_fields)
+
+            if query_counter is not None:
+                query_counter.path.pop()
                 
         return ret
         
@@ -119,13 +137,89 @@ def serialize_object(obj, recurse_on=[], requested_fields=None):
     else:
         return unicode(obj)
 
+# Encoding large pages of results in parallel. Once serialize_object has turned the
+# ORM instances into plain data, a page of results is split into chunks that are
+# encoded in a pool of worker processes (not threads, because of the GIL) and the
+# encoded chunks are concatenated in order. The output is identical to encoding
+# the page in-process.
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_encoding_pool():
+    """Returns the process pool for encoding large pages, or None if not enabled."""
+    global _pool
+    workers = getattr(settings, "API_PARALLEL_SERIALIZATION_WORKERS", None)
+    if not workers or ProcessPoolExecutor is None:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers)
+        return _pool
+
+def discard_encoding_pool(pool):
+    """Shuts down a broken pool so that a new one is started next time."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+def encode_in_parallel(func, items, *args):
+    """Calls func(chunk, *args) for chunks of items in the process pool and returns
+    the results in order, or None if the items should be encoded in-process."""
+    if len(items) < getattr(settings, "API_PARALLEL_SERIALIZATION_MIN_OBJECTS", 1000):
+        return None
+    pool = get_encoding_pool()
+    if pool is None:
+        return None
+    chunk_size = getattr(settings, "API_PARALLEL_SERIALIZATION_CHUNK_SIZE", 500)
+
+    # Pickle the chunks here rather than letting the pool do it so that values
+    # that can't be sent to the workers (e.g. from api_additional_fields, which
+    # the in-process encoder may handle) are told apart from errors in the encoder.
+    try:
+        chunks = [pickle.dumps((items[i:i + chunk_size],) + args, pickle.HIGHEST_PROTOCOL)
+                  for i in range(0, len(items), chunk_size)]
+    except Exception:
+        return None
+
+    try:
+        return list(pool.map(encode_pickled_chunk, [func] * len(chunks), chunks))
+    except BrokenProcessPool:
+        # A worker died. Encode this page in-process.
+        discard_encoding_pool(pool)
+        return None
+
+def encode_pickled_chunk(func, chunk):
+    return func(*pickle.loads(chunk))
+
+def json_date_handler(obj):
+    return obj.isoformat() if isinstance(obj, (datetime.datetime, datetime.date)) else None
+
+def encode_json_data(obj):
+    return json.dumps(obj, sort_keys=True, ensure_ascii=False, indent=True, default=json_date_handler)
+
+def encode_json_objects(objects):
+    # Encode each object as it would appear as an element of the top-level
+    # "objects" list, i.e. two levels deep. The only newlines in the output are
+    # from indentation because newlines in strings are escaped.
+    return ",\n  ".join(encode_json_data(obj).replace("\n", "\n  ") for obj in objects)
+
 def serialize_response_json_data(response):
-    date_handler = lambda obj: (
-        obj.isoformat()
-        if isinstance(obj, (datetime.datetime, datetime.date))
-        else None
-    )
-    return json.dumps(response, sort_keys=True, ensure_ascii=False, indent=True, default=date_handler)
+    if isinstance(response, dict) and isinstance(response.get("objects"), list):
+        # Encode the response without its objects and, if "objects" is the
+        # last key as usual, splice in the objects encoded in parallel.
+        head = dict(response)
+        head["objects"] = []
+        ret = encode_json_data(head)
+        tail = '"objects": []\n}'
+        if ret.endswith(tail):
+            chunks = encode_in_parallel(encode_json_objects, response["objects"])
+            if chunks is not None:
+                return ret[:-len(tail)] + '"objects": [\n  ' + ",\n  ".join(chunks) + "\n ]\n}"
+
+    return encode_json_data(response)
             
 def serialize_response_json(response):
     """Convert the response dict to JSON."""
@@ -208,16 +302,11 @@ def serialize_response_csv(response, is_list, requested_fields, format):
     raw_data = StringIO()
     writer = csv.writer(raw_data)
     writer.writerow(requested_fields)
-    def get_value_recursively(item, key):
-        for k in key.split("__"):
-            if not isinstance(item, dict): return None
-            item = item.get(k, None)
-        return item
-    def format_value(v):
-        if v != None: v = unicode(v).encode("utf8")
-        return v
-    for item in response:
-        writer.writerow([format_value(get_value_recursively(item, c)) for c in requested_fields])
+    chunks = encode_in_parallel(encode_csv_rows, response, requested_fields)
+    if chunks is None:
+        chunks = [encode_csv_rows(response, requested_fields)]
+    for chunk in chunks:
+        raw_data.write(chunk)
         
     raw_data = raw_data.getvalue()
     if (len(raw_data) > 500000 and format == "csv") or format == "csv:attachment":
@@ -231,3 +320,18 @@ def serialize_response_csv(response, is_list, requested_fields, format):
         resp['Content-Disposition'] = 'inline'
     resp["Content-Length"] = len(raw_data)
     return resp
+
+def encode_csv_rows(items, requested_fields):
+    raw_data = StringIO()
+    writer = csv.writer(raw_data)
+    def get_value_recursively(item, key):
+        for k in key.split("__"):
+            if not isinstance(item, dict): return None
+            item = item.get(k, None)
+        return item
+    def format_value(v):
+        if v != None: v = unicode(v).encode("utf8")
+        return v
+    for item in items:
+        writer.writerow([format_value(get_value_recursively(item, c)) for c in requested_fields])
+    return raw_data.getvalue()
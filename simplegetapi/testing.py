@@ -0,0 +1,36 @@
+from django.http import QueryDict
+
+from simplegetapi.queryguard import QueryCounter
+from simplegetapi.views import do_api_search
+
+def assert_constant_queries(model, qs=None, page_sizes=(1, 10), request_options=None, requested_fields=None):
+    """For use in tests. Asserts that an API search on the model runs the same number of
+    database queries whatever the page size, i.e. that serializing its results doesn't
+    run queries for each object. The database must have at least max(page_sizes) objects
+    matching the query."""
+
+    if qs is None:
+        qs = model.objects.all()
+
+    counts = []
+    for limit in page_sizes:
+        qd = QueryDict("").copy()
+        for k, v in (request_options or {}).items():
+            qd[k] = v
+        qd["limit"] = str(limit)
+
+        with QueryCounter() as counter:
+            response = do_api_search(model, qs, qd, requested_fields)
+        if not isinstance(response, dict):
+            raise AssertionError("The API search failed: %s" % response.content)
+        if len(response["objects"]) != limit:
+            raise AssertionError("The API search for limit=%d returned %d objects. Create more test objects." % (limit, len(response["objects"])))
+
+        counts.append((limit, counter))
+
+    if len(set(counter.count for limit, counter in counts)) > 1:
+        raise AssertionError("The number of queries to serialize %s depends on the page size: %s. Queries by field: %s" % (
+            model._meta.object_name,
+            ", ".join("%d queries for %d objects" % (counter.count, limit) for limit, counter in counts),
+            counts[-1][1].by_path,
+        ))
@@ -0,0 +1,163 @@
+import atexit, threading
+
+from django.conf import settings
+
+# Opt-in recording of which filter and sort combinations ("shapes") clients send
+# in API searches, with latency histograms and row counts. Stats are aggregated
+# in memory and periodically merged into a cache shared by all processes, from
+# which the api_usage_report management command reads them.
+
+CACHE_KEY = "simplegetapi:usage"
+
+# Upper bounds of the latency histogram buckets, in milliseconds. The last
+# bucket counts everything slower.
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+_stats = { }
+_stats_lock = threading.Lock()
+_flush_timer = None
+
+def is_enabled():
+    return getattr(settings, "API_USAGE_STATS", False)
+
+def get_cache():
+    from django.core.cache import caches
+    return caches[getattr(settings, "API_USAGE_STATS_CACHE", "default")]
+
+def get_shape(qs_filters, qs_sort):
+    """Returns a hashable description of the filters and sort in a query, ignoring their values."""
+    return (
+        tuple(sorted((fieldname, matchoperator) for fieldname, (matchoperator, modelfield) in qs_filters.items())),
+        tuple(qs_sort),
+    )
+
+def new_shape_stats():
+    return {
+        "count": 0,
+        "total_time": 0.0,
+        "max_time": 0.0,
+        "total_rows": 0,
+        "max_rows": 0,
+        "histogram": [0] * (len(LATENCY_BUCKETS) + 1),
+    }
+
+def merge_shape_stats(into, other):
+    into["count"] += other["count"]
+    into["total_time"] += other["total_time"]
+    into["max_time"] = max(into["max_time"], other["max_time"])
+    into["total_rows"] += other["total_rows"]
+    into["max_rows"] = max(into["max_rows"], other["max_rows"])
+    into["histogram"] = [a + b for a, b in zip(into["histogram"], other["histogram"])]
+
+def record_search(model, qs_filters, qs_sort, elapsed, rows):
+    """Records the latency (in seconds) and total row count of an API search."""
+
+    global _flush_timer
+
+    model_label = "%s.%s" % (model._meta.app_label, model._meta.object_name)
+    shape = get_shape(qs_filters, qs_sort)
+    ms = elapsed * 1000.0
+    bucket = len([b for b in LATENCY_BUCKETS if ms > b])
+
+    with _stats_lock:
+        stats = _stats.setdefault(model_label, { }).setdefault(shape, new_shape_stats())
+        stats["count"] += 1
+        stats["total_time"] += elapsed
+        stats["max_time"] = max(stats["max_time"], elapsed)
+        stats["total_rows"] += rows
+        stats["max_rows"] = max(stats["max_rows"], rows)
+        stats["histogram"][bucket] += 1
+
+        # Flush on a timer rather than on a later request so that the stats
+        # reach the cache even if the process goes idle.
+        if _flush_timer is None:
+            _flush_timer = threading.Timer(getattr(settings, "API_USAGE_STATS_FLUSH_INTERVAL", 60), flush_pending)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+def flush_pending():
+    """Flushes the stats aggregated in this process since the last flush."""
+
+    global _flush_timer
+
+    with _stats_lock:
+        pending = dict(_stats)
+        _stats.clear()
+        _flush_timer = None
+
+    if pending:
+        flush(pending)
+
+# Don't lose the last window when the process exits normally.
+atexit.register(flush_pending)
+
+def flush(pending):
+    """Merges stats aggregated in this process into the shared cache."""
+
+    # This read-modify-write isn't atomic, so a flush from another process at
+    # the same moment can be lost. That's fine for usage statistics.
+    cache = get_cache()
+    stats = cache.get(CACHE_KEY) or { }
+    for model_label, shapes in pending.items():
+        model_stats = stats.setdefault(model_label, { })
+        for shape, shape_stats in shapes.items():
+            merge_shape_stats(model_stats.setdefault(shape, new_shape_stats()), shape_stats)
+    cache.set(CACHE_KEY, stats, None)
+
+def get_stats():
+    return get_cache().get(CACHE_KEY) or { }
+
+def reset_stats():
+    get_cache().delete(CACHE_KEY)
+
+def get_latency_percentile(stats, percentile):
+    """Returns the upper bound of the histogram bucket containing the given
+    percentile, in milliseconds, or None if it is in the last bucket."""
+    threshold = stats["count"] * percentile / 100.0
+    seen = 0
+    for i, n in enumerate(stats["histogram"]):
+        seen += n
+        if seen >= threshold:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else None
+    return None
+
+def suggest_index(shape):
+    """Suggests the fields of a composite index for a query shape, or None if
+    a single-column index would do."""
+
+    filters, sort = shape
+
+    # Equality filters go first, then at most one range filter, then the sort
+    # fields (an index can't also serve a sort after a range filter).
+    # contains filters (LIKE '%x%') can't use a B-tree index, so leave them out.
+    equality = [f for f, op in filters if op in ("exact", "in")]
+    ranges = [f for f, op in filters if op not in ("exact", "in", "contains")]
+    fields = list(equality)
+    if ranges:
+        fields.append(ranges[0])
+    else:
+        fields += [f if ascdesc == "+" else "-" + f for f, ascdesc in sort if f not in fields]
+    if len(fields) < 2:
+        return None
+    return fields
+
+def suggest_filter_if(shape, model_stats):
+    """Suggests an api_filter_if rule for a query shape that filters on just one
+    field, requiring the field that clients most often filter on alongside it."""
+
+    filters, sort = shape
+    if len(filters) != 1:
+        return None
+    fieldname = filters[0][0]
+
+    co_filters = { }
+    for other_shape, stats in model_stats.items():
+        other_fields = [f for f, op in other_shape[0]]
+        if fieldname not in other_fields:
+            continue
+        for f in other_fields:
+            if f != fieldname:
+                co_filters[f] = co_filters.get(f, 0) + stats["count"]
+    if not co_filters:
+        return None
+    return (fieldname, max(co_filters, key=lambda f : co_filters[f]))
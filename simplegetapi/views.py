@@ -4,11 +4,12 @@ from django.db.models.fields.related import ForeignKey, ManyToManyField
 from django.shortcuts import get_object_or_404, render
 from django.urls import reverse
 from django.conf import settings
-import csv, json, datetime, lxml, urllib
+import csv, json, datetime, time, lxml, urllib
 import dateutil.parser
 
 from simplegetapi.utils import is_enum, enum_key_to_value, enum_get_values, get_orm_fields
 from simplegetapi.serializers import serialize_object, serialize_response_json_data, serialize_response_json, serialize_response_jsonp, serialize_response_xml, serialize_response_csv
+from simplegetapi import coalesce, admission, routing, usage, queryguard
 
 def get_api_models():
     if not hasattr(settings, 'API_MODELS') or not isinstance(settings.API_MODELS, dict):
@@ -67,7 +68,17 @@ def do_api_call(request, model, qs, id):
     if request.method != "GET":
         # This is a GET-only API.
         return HttpResponseNotAllowed(["GET"])
-    
+
+    # Let identical concurrent requests share one computation of the response.
+    if coalesce.is_enabled():
+        return coalesce.coalesce(coalesce.get_request_key(request, model),
+            lambda : build_api_response(request, model, qs, id))
+
+    return build_api_response(request, model, qs, id)
+
+def build_api_response(request, model, qs, id):
+    """Runs a GET API request and encodes the result as an HttpResponse."""
+
     # The user can specify which fields he wants as a comma-separated list. Also supports
     # field__field chaining for related objects.
     requested_fields = [f.strip() for f in request.GET.get("fields", "").split(',') if f.strip() != ""]
@@ -124,6 +135,11 @@ def do_api_search(model, qs, request_options, requested_fields):
     # Get model information specifying how to format API results for calls rooted on this model.
     recurse_on = getattr(model, "api_recurse_on", [])
 
+    # Pin all of the queries for this request to one database.
+    database = routing.get_model_database(model)
+    if database is not None and qs_type == "QuerySet":
+        qs = qs.using(database)
+
     # Apply filters specified in the query string.
 
     qs_sort = []
@@ -256,43 +272,70 @@ def do_api_search(model, qs, request_options, requested_fields):
     if offset > 1000:
        return HttpResponseBadRequest("Offset > 1000 is not permitted.")
 
-    # Get total count before applying offset/limit.
+    # Hold back expensive queries if too many are already running on this model.
+    semaphore = admission.get_admission_semaphore(model, qs, qs_type, qs_filters, qs_sort)
+    if semaphore is not None and not semaphore.acquire(False):
+        return admission.too_busy_response()
     try:
-        count = qs.count()
-    except ValueError as e:
-        return HttpResponseBadRequest("A parameter is invalid: %s" % str(e))
-    except Exception as e:
-        return HttpResponseBadRequest("Something is wrong with the query: %s" % repr(e))
+        started = time.time()
+
+        # Get total count before applying offset/limit.
+        try:
+            count = qs.count()
+        except ValueError as e:
+            return HttpResponseBadRequest("A parameter is invalid: %s" % str(e))
+        except Exception as e:
+            return HttpResponseBadRequest("Something is wrong with the query: %s" % repr(e))
 
-    # Apply offset/limit.
-    qs = qs[offset:offset + limit]
+        # Apply offset/limit.
+        qs = qs[offset:offset + limit]
 
-    # Bulk-load w/ prefetch_related, but keep order.
+        # Bulk-load w/ prefetch_related, but keep order.
     
-    if qs_type == "QuerySet":
-        # For Django ORM QuerySets, just add prefetch_related based on the fields
-        # we're allowed to recurse inside of.
-        objs = qs.prefetch_related(*recurse_on) 
-    elif qs_type == "SearchQuerySet":
-        # For Haystack SearchQuerySets, we need to get the ORM instance IDs,
-        # pull the objects in bulk, and then sort by the original return order.
-        ids = [entry.pk for entry in qs]
-        id_index = { int(id): i for i, id in enumerate(ids) }
-        objs = list(model.objects.filter(id__in=ids).prefetch_related(*recurse_on))
-        objs.sort(key = lambda ob : id_index[int(ob.id)])
-    else:
-        raise Exception(qs_type)
+        if qs_type == "QuerySet":
+            # For Django ORM QuerySets, just add prefetch_related based on the fields
+            # we're allowed to recurse inside of.
+            objs = qs.prefetch_related(*recurse_on) 
+        elif qs_type == "SearchQuerySet":
+            # For Haystack SearchQuerySets, we need to get the ORM instance IDs,
+            # pull the objects in bulk, and then sort by the original return order.
+            ids = [entry.pk for entry in qs]
+            id_index = { int(id): i for i, id in enumerate(ids) }
+            objs = model.objects.all() if database is None else model.objects.using(database)
+            objs = list(objs.filter(id__in=ids).prefetch_related(*recurse_on))
+            objs.sort(key = lambda ob : id_index[int(ob.id)])
+        else:
+            raise Exception(qs_type)
+
+        # Serialize.
+        if not queryguard.is_enabled():
+            objects = [serialize_object(s, recurse_on=recurse_on, requested_fields=requested_fields) for s in objs]
+        else:
+            # Load the page and its prefetches first, then check that serializing
+            # it doesn't run queries for each object.
+            objs = list(objs)
+            with queryguard.QueryCounter() as counter:
+                objects = [serialize_object(s, recurse_on=recurse_on, requested_fields=requested_fields) for s in objs]
+            queryguard.check_serialization_queries(model, counter, len(objs))
+
+        response = {
+            "meta": {
+                "offset": offset,
+                "limit": limit,
+                "total_count": count,
+            },
+            "objects": objects,
+        }
+
+        # Record the filter/sort shape of the query and how long it took.
+        if usage.is_enabled():
+            usage.record_search(model, qs_filters, qs_sort, time.time() - started, count)
+
+        return response
+    finally:
+        if semaphore is not None:
+            semaphore.release()
 
-    # Serialize.
-    return {
-        "meta": {
-            "offset": offset,
-            "limit": limit,
-            "total_count": count,
-        },
-        "objects": [serialize_object(s, recurse_on=recurse_on, requested_fields=requested_fields) for s in objs],
-    }
- 
 def normalize_field_value(v, model, modelfield):
     # Convert "null" to None.
     if v.lower() == "null":
@@ -387,7 +430,8 @@ def do_api_get_object(model, id, requested_fields):
     """Gets a single object by primary key."""
     
     # Object ID is known.
-    obj = get_object_or_404(model, id=id)
+    database = routing.get_model_database(model)
+    obj = get_object_or_404(model if database is None else model.objects.using(database), id=id)
 
     # Get model information specifying how to format API results for calls rooted on this model.
     recurse_on = list(getattr(model, "api_recurse_on", []))